@@ -0,0 +1,19 @@
+# Gunicorn settings for the Deepdub VAPI proxy.
+# Each /tts request spends almost all of its time waiting on Deepdub, so threaded
+# workers keep many requests in flight per process instead of serializing them.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = "gthread"
+# Fixed rather than os.cpu_count(), which sees the host's CPUs inside a container.
+# Every worker has its own Deepdub cap, TTS cache and sentence pool, so the
+# proxy-wide totals are these multiplied by the worker count.
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+timeout = 60
+
+# Outlive typical load balancer idle timeouts (60s) so VAPI's connections stay reusable
+keepalive = 75
+
+# Heartbeat files on tmpfs so a slow container disk can't stall workers
+worker_tmp_dir = "/dev/shm"
@@ -1,397 +1,1229 @@
 from flask import Flask, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import time
+import logging
+import logging.handlers
+import queue
+import atexit
 import uuid
 from dotenv import load_dotenv
 import io
 import wave
 import struct
-import tempfile
+import hashlib
+import hmac
+import math
+import re
+import functools
+import importlib.util
+import bisect
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
 
+# Use orjson for request parsing and jsonify() when it is installed
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+if ORJSON_AVAILABLE:
+    class ORJSONProvider(DefaultJSONProvider):
+        """Flask JSON provider backed by orjson; formatting kwargs are ignored."""
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = ORJSONProvider(app)
+
+# Defaults to WARNING; LOG_LEVEL=INFO adds per-request start/completion lines and
+# LOG_LEVEL=DEBUG brings back the full per-request trace (payloads, headers, hex dumps).
+# Messages use %-style arguments so nothing is formatted for records that get filtered out.
+# Request threads only enqueue records; a listener thread does the stderr writes, so a
+# slow log pipe never holds up a response. Started per worker (gunicorn doesn't preload).
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush what's still queued on shutdown
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))  # Full formatting happens on the listener
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(), handlers=[queue_handler])
+logger = logging.getLogger("deepdub_proxy")
+
 DEEPDUB_API_KEY = os.getenv("DEEPDUB_API_KEY")
 VOICE_PROMPT_ID = os.getenv("DEEPDUB_VOICE_PROMPT_ID")
 VAPI_SECRET = os.getenv("VAPI_SECRET", "deepdub-secret-2025")  # Default value for testing
+VAPI_SECRET_BYTES = VAPI_SECRET.encode("utf-8")
+
+# VAPI voice requests are a few hundred bytes; anything far bigger is rejected before parsing
+MAX_TTS_BODY_BYTES = 64 * 1024
+app.config["MAX_CONTENT_LENGTH"] = MAX_TTS_BODY_BYTES
 
 # Demo mode for testing without real API credentials
 DEMO_MODE = os.getenv("DEMO_MODE", "false").lower() == "true"
 
+# Everything in a Deepdub request except the text is fixed for the deployment,
+# so build it once instead of on every /tts call
+DEEPDUB_TTS_URL = "https://restapi.deepdub.ai/tts"
+DEEPDUB_HEADERS = {
+    "Content-Type": "application/json",
+    "x-api-key": DEEPDUB_API_KEY
+}
+# Ask Deepdub for exactly what we send on: 16-bit WAV at the rate direct audio is
+# forced to, so the common case streams straight through without conversion
+DEEPDUB_OUTPUT_RATE = 8000
+DEEPDUB_PAYLOAD_TEMPLATE = {
+    "model": "dd-etts-2.5",
+    "locale": "he-IL",
+    "voicePromptId": VOICE_PROMPT_ID,
+    "format": "wav",
+    "sampleRate": DEEPDUB_OUTPUT_RATE
+}
+
+# Shared HTTP session so calls to Deepdub (and its audioUrl host) reuse pooled
+# keep-alive connections instead of paying a TCP + TLS handshake per request.
+# The pool is sized above the default gunicorn thread count (see gunicorn.conf.py).
+# Synthesis is idempotent, so gateway errors are retried quickly for POST as well;
+# the last response is still returned so non-200 handling stays in one place.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+# Retry-After is ignored so a rate-limited call can't park a worker thread for a minute.
+HTTP_RETRY = Retry(
+    total=2,
+    connect=2,
+    read=1,
+    backoff_factor=0.2,
+    status_forcelist=[429, 502, 503, 504],
+    allowed_methods=frozenset({"GET", "POST"}),
+    respect_retry_after_header=False,
+    raise_on_status=False
+)
+# (connect, read): a stalled TLS handshake fails fast instead of holding a worker for the full read budget
+DEEPDUB_TIMEOUT = (3.05, 20)
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=HTTP_RETRY))
+
+# Cap simultaneous Deepdub requests per worker so a burst of distinct texts doesn't
+# trip the upstream quota; the slot is held until Deepdub starts answering.
+# The proxy-wide cap is this times the gunicorn worker count (WEB_CONCURRENCY).
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "8"))
+UPSTREAM_WAIT_TIMEOUT = 10  # seconds to wait for a free slot before giving up
+_upstream_slots = threading.BoundedSemaphore(UPSTREAM_CONCURRENCY)
+
+# Long texts are split into sentences: the first one streams to VAPI while the rest are
+# synthesized ahead on this pool, so time-to-first-audio tracks the first sentence
+SENTENCE_SPLIT_MIN_CHARS = int(os.getenv("SENTENCE_SPLIT_MIN_CHARS", "150"))
+SENTENCE_WORKERS = int(os.getenv("SENTENCE_WORKERS", "4"))
+SENTENCE_END = re.compile(r'(?<=[.!?\u05c3])\s+|\n+')  # \u05c3 is the Hebrew sof pasuq
+_sentence_pool = ThreadPoolExecutor(max_workers=SENTENCE_WORKERS, thread_name_prefix="tts-sentence")
+
 # Check required environment variables
 if not DEEPDUB_API_KEY and not DEMO_MODE:
-    print("WARNING: DEEPDUB_API_KEY environment variable not set!")
-    print("Please set it before running the proxy, or set DEMO_MODE=true for testing.")
+    logger.warning("DEEPDUB_API_KEY environment variable not set! "
+                   "Please set it before running the proxy, or set DEMO_MODE=true for testing.")
     
 if not VOICE_PROMPT_ID and not DEMO_MODE:
-    print("WARNING: DEEPDUB_VOICE_PROMPT_ID environment variable not set!")
-    print("Please set it before running the proxy, or set DEMO_MODE=true for testing.")
+    logger.warning("DEEPDUB_VOICE_PROMPT_ID environment variable not set! "
+                   "Please set it before running the proxy, or set DEMO_MODE=true for testing.")
 
 if DEMO_MODE:
-    print("🎭 DEMO MODE: Running without real Deepdub API calls")
+    logger.info("🎭 DEMO MODE: Running without real Deepdub API calls")
 else:
-    print("🚀 PRODUCTION MODE: Using real Deepdub API")
-    print(f"API Key: {DEEPDUB_API_KEY[:10]}..." if DEEPDUB_API_KEY else "API Key: None")
-    print(f"Voice Prompt ID: {VOICE_PROMPT_ID}")
+    logger.info("🚀 PRODUCTION MODE: Using real Deepdub API")
+    logger.info("API Key: %s", f"{DEEPDUB_API_KEY[:10]}..." if DEEPDUB_API_KEY else None)
+    logger.info("Voice Prompt ID: %s", VOICE_PROMPT_ID)
+
+# Open a pooled connection to Deepdub as soon as the worker starts, so the first
+# VAPI request doesn't pay the TCP + TLS handshake
+DEEPDUB_WARMUP = os.getenv("DEEPDUB_WARMUP", "true").lower() == "true"
+
+def warm_deepdub_connection():
+    try:
+        HTTP_SESSION.head(DEEPDUB_TTS_URL, timeout=DEEPDUB_TIMEOUT).close()
+        logger.debug("Deepdub connection warmed up")
+    except requests.exceptions.RequestException as warmup_error:
+        logger.debug("Deepdub warm-up failed: %s", warmup_error)
+
+if DEEPDUB_WARMUP and not DEMO_MODE:
+    threading.Thread(target=warm_deepdub_connection, name="deepdub-warmup", daemon=True).start()
 
 # Check if pydub is available for audio conversion
-def check_pydub_available():
-    """Check if pydub is available and can handle audio conversion"""
+@functools.cache
+def load_pydub():
+    """Import pydub on first use and check it can handle audio conversion.
+
+    Returns the AudioSegment class, or None when pydub or its dependencies are missing.
+    Deferred so startup and requests that never leave the native WAV path skip the import.
+    """
     try:
         from pydub import AudioSegment
         # Test if we can create a simple audio segment (this will fail if dependencies are missing)
-        test_audio = AudioSegment.silent(duration=100)
-        return True
-    except ImportError:
-        return False
+        AudioSegment.silent(duration=100)
     except Exception:
-        # pydub might be installed but missing dependencies (ffmpeg, etc.)
-        return False
-
-# Check pydub availability at startup
-PYDUB_AVAILABLE = check_pydub_available()
-if not PYDUB_AVAILABLE:
-    print("⚠️  pydub not available or missing dependencies!")
-    print("   For full MP3 support, install: pip install pydub")
-    print("   And ensure ffmpeg is available on the system")
-    print("   WAV files will still be processed natively")
-else:
-    print("✅ pydub found - full audio conversion available")
+        # ImportError, or pydub installed but missing dependencies (ffmpeg, etc.)
+        logger.warning("⚠️  pydub not available or missing dependencies! "
+                       "For full MP3 support, install: pip install pydub, and ensure ffmpeg is available on the system. "
+                       "WAV files will still be processed natively")
+        return None
+    logger.info("✅ pydub found - full audio conversion available")
+    return AudioSegment
+
+# NumPy handles sample-level audio work (downmixing, resampling) when installed.
+# Imported on first use so workers that only stream matching WAV never load it.
+@functools.cache
+def load_numpy():
+    """Return the numpy module, or None when it isn't installed"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+# soundfile (libsndfile) decodes MP3 and friends in-process, so no ffmpeg subprocess or temp files
+@functools.cache
+def load_native_decoder():
+    """
+    Import soundfile and scipy on first use.
+
+    Returns (soundfile module, scipy resample_poly), or None when either (or NumPy) is missing.
+    """
+    if load_numpy() is None:
+        return None
+    try:
+        import soundfile
+        from scipy.signal import resample_poly
+    except (ImportError, OSError):
+        # OSError: soundfile installed but libsndfile can't be loaded
+        logger.info("soundfile/scipy not available - non-WAV audio will be converted with pydub")
+        return None
+    logger.info("✅ soundfile %s found - in-process audio decoding available", soundfile.__libsndfile_version__)
+    return soundfile, resample_poly
 
-VALID_SAMPLE_RATES = [8000, 16000, 22050, 24000, 44100]
+@functools.cache
+def resample_taps(up, down):
+    """The Kaiser low-pass FIR resample_poly designs for an up/down pair, built once per pair"""
+    from scipy.signal import firwin
+    max_rate = max(up, down)
+    taps = firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+    return taps.astype(load_numpy().float32)
+
+def resample_mono(resample_poly, mono, framerate, sample_rate):
+    """Polyphase-resample float32 mono samples from framerate to sample_rate"""
+    divisor = math.gcd(sample_rate, framerate)
+    up, down = sample_rate // divisor, framerate // divisor
+    # resample_poly copies a window it's given, so the cached taps stay untouched
+    return resample_poly(mono, up, down, window=resample_taps(up, down))
+
+def decode_with_soundfile(audio_data, sample_rate):
+    """Decode compressed audio to 16-bit mono PCM at sample_rate without leaving the process, or None"""
+    decoder = load_native_decoder()
+    if decoder is None:
+        return None
+    soundfile, resample_poly = decoder
+    np = load_numpy()
+
+    try:
+        with soundfile.SoundFile(io.BytesIO(audio_data)) as sound:
+            framerate = sound.samplerate
+            # Already at the target rate: let libsndfile hand back int16 and skip float entirely
+            native_rate = framerate == sample_rate
+            samples = sound.read(dtype='int16' if native_rate else 'float32', always_2d=True)
+    except Exception as sf_error:
+        # Format libsndfile doesn't know - pydub/ffmpeg gets a go instead
+        logger.debug("soundfile could not decode audio: %s", sf_error)
+        return None
+
+    channels = samples.shape[1]
+    logger.debug("Decoded with soundfile: %d channels, %dHz, %d frames", channels, framerate, samples.shape[0])
+    if native_rate:
+        if channels == 1:
+            return samples.tobytes()
+        # Integer downmix: sum as int32 so the channels can't overflow
+        return (samples.sum(axis=1, dtype=np.int32) // channels).astype('<i2').tobytes()
+
+    mono = samples.mean(axis=1) if channels > 1 else samples[:, 0]
+    mono = resample_mono(resample_poly, mono, framerate, sample_rate)
+    # Clip and scale in place so the only new buffer is the int16 one
+    np.clip(mono, -1.0, 1.0, out=mono)
+    mono *= 32767
+    return mono.astype('<i2').tobytes()
+
+VALID_SAMPLE_RATES = frozenset({8000, 16000, 22050, 24000, 44100})
 SAMPLE_RATE = 8000  # Default sample rate for PCM conversion
 
+def parse_wav_header(audio_data):
+    """
+    Walk the RIFF chunks of a PCM WAV file without going through the wave module.
+
+    Args:
+        audio_data: Raw audio bytes starting with a RIFF/WAVE header
+
+    Returns:
+        (channels, sample_width, framerate, data_offset, data_size) or None if
+        the header isn't a PCM layout we understand
+    """
+    if len(audio_data) < 12 or audio_data[:4] != b'RIFF' or audio_data[8:12] != b'WAVE':
+        return None
+
+    fmt = None
+    offset = 12
+    end = len(audio_data)
+    while offset + 8 <= end:
+        chunk_id, chunk_size = struct.unpack_from('<4sI', audio_data, offset)
+        body = offset + 8
+
+        if chunk_id == b'fmt ':
+            if chunk_size < 16 or body + 16 > end:
+                return None
+            audio_format, channels, framerate, _, _, bits = struct.unpack_from('<HHIIHH', audio_data, body)
+            if audio_format not in (1, 0xFFFE):  # PCM or WAVE_FORMAT_EXTENSIBLE
+                return None
+            fmt = (channels, bits // 8, framerate)
+
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            # Streamed WAVs often carry a 0 or 0xFFFFFFFF placeholder size
+            available = end - body
+            data_size = chunk_size if 0 < chunk_size <= available else available
+            return fmt + (body, data_size)
+
+        offset = body + chunk_size + (chunk_size & 1)  # chunks are word-aligned
+
+    return None
+
+def convert_pcm16_frames(frames, channels, framerate, sample_rate):
+    """
+    Downmix and resample 16-bit WAV frames to mono PCM at sample_rate.
+
+    Reads the buffer in place, averages the channels and (if needed) runs a polyphase
+    resample in a single NumPy pipeline. Returns None when NumPy, or scipy for
+    resampling, isn't available.
+    """
+    np = load_numpy()
+    if np is None:
+        return None
+    resample_poly = None
+    if framerate != sample_rate:
+        decoder = load_native_decoder()
+        if decoder is None:
+            return None
+        resample_poly = decoder[1]
+
+    frame_bytes = 2 * channels
+    usable = len(frames) - len(frames) % frame_bytes
+    samples = np.frombuffer(frames[:usable], dtype='<i2').reshape(-1, channels)
+
+    if resample_poly is None:
+        # Downmix only: sum as int32 so the channels can't overflow
+        return (samples.sum(axis=1, dtype=np.int32) // channels).astype('<i2').tobytes()
+
+    mono = samples.mean(axis=1, dtype=np.float32) if channels > 1 else samples[:, 0].astype(np.float32)
+    resampled = resample_mono(resample_poly, mono, framerate, sample_rate)
+    # Round and clip in place so the only new buffer is the int16 one
+    np.rint(resampled, out=resampled)
+    np.clip(resampled, -32768, 32767, out=resampled)
+    return resampled.astype('<i2').tobytes()
+
+# ID3 tag, or a bare MPEG audio frame sync (MPEG-1/2 Layer III, with and without CRC)
+MP3_MAGICS = (b'ID3', b'\xff\xfb', b'\xff\xfa', b'\xff\xf3', b'\xff\xf2')
+
+def sniff_audio_format(audio_data):
+    """Identify the container from its magic bytes: "wav", "mp3", or None"""
+    if audio_data[:4] == b'RIFF' and audio_data[8:12] == b'WAVE':
+        return "wav"
+    if audio_data.startswith(MP3_MAGICS):
+        return "mp3"
+    return None
+
 def convert_audio_to_pcm(audio_data, sample_rate=SAMPLE_RATE):
     """
     Convert audio data to raw PCM format that Vapi expects.
     
-    Supports WAV files natively. For MP3, uses pydub if available.
+    16-bit WAV is handled natively. Other bit depths, MP3 and anything else are decoded
+    in-process with soundfile when it's installed, and with pydub (ffmpeg) otherwise.
     
     Args:
         audio_data: Raw audio bytes (MP3, WAV, etc.)
         sample_rate: Target sample rate for PCM output (default 8000Hz)
     
     Returns:
-        Raw PCM bytes (16-bit, mono) or original data if conversion fails
+        (audio, converted): raw PCM bytes (16-bit, mono) and True, or the original
+        data and False if conversion fails
     """
     try:
         # Check if it's a WAV file by looking at the header first (faster)
-        if audio_data.startswith(b'RIFF') and b'WAVE' in audio_data[:12]:
-            print("Detected WAV format, attempting to extract PCM data")
-            
-            # Try to parse WAV file and extract PCM data using wave module (faster)
-            audio_buffer = io.BytesIO(audio_data)
-            try:
-                with wave.open(audio_buffer, 'rb') as wav_file:
-                    # Get WAV parameters
-                    channels = wav_file.getnchannels()
-                    sample_width = wav_file.getsampwidth()
-                    framerate = wav_file.getframerate()
-                    
-                    print(f"WAV info: {channels} channels, {sample_width} bytes/sample, {framerate} Hz")
-                    
-                    # Read all frames
-                    frames = wav_file.readframes(wav_file.getnframes())
-                    
-                    # Simple resample if needed (basic approach)
-                    if framerate != sample_rate:
-                        print(f"WAV sample rate ({framerate}Hz) doesn't match target ({sample_rate}Hz)")
-                        print("Note: Basic resampling - for best quality, ensure Deepdub returns correct sample rate")
-                        # For now, we'll keep the original rate and let VAPI handle it
-                        # Advanced resampling would require additional libraries
-                    
-                    # Convert to mono if stereo (simple approach - take left channel)
-                    if channels == 2 and sample_width == 2:  # 16-bit stereo
-                        # Convert stereo to mono by taking every other sample
-                        mono_frames = bytearray()
-                        for i in range(0, len(frames), 4):  # 4 bytes = 2 samples of 16-bit
-                            if i + 1 < len(frames):
-                                mono_frames.extend(frames[i:i+2])  # Take left channel
-                        frames = bytes(mono_frames)
-                        print(f"Converted stereo to mono, new size: {len(frames)} bytes")
-                    
-                    # Ensure 16-bit format
-                    if sample_width != 2:
-                        print(f"Warning: WAV is {sample_width * 8}-bit, expected 16-bit")
-                        print("Advanced bit depth conversion requires additional libraries")
-                        # For now, return as-is and let VAPI handle it
-                    
-                    return frames
-                    
-            except Exception as wav_error:
-                print(f"Failed to parse WAV file with wave module: {wav_error}")
-                print("Falling back to pydub for WAV processing")
-                # Fall through to pydub processing below
-        
-        # For all other formats (MP3, or WAV that failed above), use pydub
-        if not PYDUB_AVAILABLE:
-            print("pydub not available - cannot convert audio to PCM")
-            print("Returning original audio data (Vapi may not support this)")
-            return audio_data
+        audio_format = sniff_audio_format(audio_data)
+        if audio_format == "wav":
+            logger.debug("Detected WAV format, attempting to extract PCM data")
+
+            # Read the header by hand and slice the data chunk out without copying
+            wav_info = parse_wav_header(audio_data)
+            if wav_info is not None:
+                channels, sample_width, framerate, data_offset, data_size = wav_info
+                frames = memoryview(audio_data)[data_offset:data_offset + data_size]
+            else:
+                # Unusual header layout - let the wave module have a go
+                try:
+                    with wave.open(io.BytesIO(audio_data), 'rb') as wav_file:
+                        channels = wav_file.getnchannels()
+                        sample_width = wav_file.getsampwidth()
+                        framerate = wav_file.getframerate()
+                        frames = wav_file.readframes(wav_file.getnframes())
+                except Exception as wav_error:
+                    logger.warning("Failed to parse WAV file with wave module: %s - trying soundfile / pydub", wav_error)
+                    frames = None  # Fall through to soundfile / pydub below
+
+            if frames is not None:
+                logger.debug("WAV info: %d channels, %d bytes/sample, %d Hz", channels, sample_width, framerate)
+
+                # Other bit depths need real decoding, which soundfile does in one pass
+                if sample_width != 2:
+                    pcm_data = decode_with_soundfile(audio_data, sample_rate)
+                    if pcm_data is not None:
+                        logger.debug("Converted %d-bit WAV to PCM: %d bytes", sample_width * 8, len(pcm_data))
+                        return pcm_data, True
+
+                # 16-bit audio that needs downmixing or resampling goes through one NumPy pass
+                if sample_width == 2 and (channels != 1 or framerate != sample_rate):
+                    pcm_data = convert_pcm16_frames(frames, channels, framerate, sample_rate)
+                    if pcm_data is not None:
+                        logger.debug("Converted WAV to %dHz mono PCM: %d bytes", sample_rate, len(pcm_data))
+                        return pcm_data, True
+
+                # Simple resample if needed (basic approach)
+                if framerate != sample_rate:
+                    logger.warning("WAV sample rate (%dHz) doesn't match target (%dHz); "
+                                   "for best quality, ensure Deepdub returns correct sample rate", framerate, sample_rate)
+                    # For now, we'll keep the original rate and let VAPI handle it
+                    # Advanced resampling would require additional libraries
+
+                # Convert to mono if stereo
+                if channels == 2 and sample_width == 2:  # 16-bit stereo
+                    # Simple approach without NumPy - take left channel: view the buffer as
+                    # 16-bit samples and copy every other one out in one exact-size C-level pass
+                    usable = len(frames) - len(frames) % 4  # 4 bytes = 2 samples of 16-bit
+                    frames = memoryview(frames)[:usable].cast('h')[::2].tobytes()
+                    logger.debug("Converted stereo to mono, new size: %d bytes", len(frames))
+
+                # Ensure 16-bit format
+                if sample_width != 2:
+                    logger.warning("WAV is %d-bit, expected 16-bit; "
+                                   "bit depth conversion requires soundfile", sample_width * 8)
+                    # For now, return as-is and let VAPI handle it
+
+                return bytes(frames), True
+
+        # For all other formats (MP3, or WAV that failed above), decode in-process when possible
+        pcm_data = decode_with_soundfile(audio_data, sample_rate)
+        if pcm_data is not None:
+            logger.debug("Successfully converted to PCM: %d bytes", len(pcm_data))
+            return pcm_data, True
+
+        # Otherwise use pydub
+        AudioSegment = load_pydub()
+        if AudioSegment is None:
+            logger.warning("pydub not available - cannot convert audio to PCM; "
+                           "returning original audio data (Vapi may not support this)")
+            return audio_data, False
         
+        CONVERSION_FALLBACKS.inc()
         try:
-            from pydub import AudioSegment
-            
-            print(f"Using pydub to convert audio to PCM (target: {sample_rate}Hz, 16-bit, mono)")
+            logger.debug("Using pydub to convert audio to PCM (target: %dHz, 16-bit, mono)", sample_rate)
             
             # Load audio from bytes using pydub
             audio_buffer = io.BytesIO(audio_data)
             
             # Try to detect format and load
-            if audio_data.startswith(b'ID3') or audio_data.startswith(b'\xff\xfb') or audio_data.startswith(b'\xff\xfa'):
-                print("Loading as MP3")
+            if audio_format == "mp3":
+                logger.debug("Loading as MP3")
                 audio = AudioSegment.from_mp3(audio_buffer)
-            elif audio_data.startswith(b'RIFF') and b'WAVE' in audio_data[:12]:
-                print("Loading as WAV")
+            elif audio_format == "wav":
+                logger.debug("Loading as WAV")
                 audio = AudioSegment.from_wav(audio_buffer)
             else:
-                print("Unknown format, trying auto-detection")
+                logger.debug("Unknown format, trying auto-detection")
                 audio = AudioSegment.from_file(audio_buffer)
             
-            print(f"Original audio: {audio.channels} channels, {audio.frame_rate}Hz, {audio.sample_width * 8}-bit")
+            logger.debug("Original audio: %d channels, %dHz, %d-bit", audio.channels, audio.frame_rate, audio.sample_width * 8)
             
             # Convert to target sample rate
             if audio.frame_rate != sample_rate:
-                print(f"Resampling from {audio.frame_rate}Hz to {sample_rate}Hz")
+                logger.debug("Resampling from %dHz to %dHz", audio.frame_rate, sample_rate)
                 audio = audio.set_frame_rate(sample_rate)
             
             # Convert to mono if stereo
             if audio.channels > 1:
-                print("Converting to mono")
+                logger.debug("Converting to mono")
                 audio = audio.set_channels(1)
             
             # Convert to 16-bit
             if audio.sample_width != 2:
-                print(f"Converting from {audio.sample_width * 8}-bit to 16-bit")
+                logger.debug("Converting from %d-bit to 16-bit", audio.sample_width * 8)
                 audio = audio.set_sample_width(2)
             
-            # Export as raw PCM data
-            pcm_buffer = io.BytesIO()
-            audio.export(pcm_buffer, format="raw")
-            pcm_data = pcm_buffer.getvalue()
+            # The samples are already decoded - take them directly instead of a raw export through BytesIO
+            pcm_data = audio.raw_data
             
-            print(f"Successfully converted to PCM: {len(pcm_data)} bytes")
-            return pcm_data
+            logger.debug("Successfully converted to PCM: %d bytes", len(pcm_data))
+            return pcm_data, True
             
         except Exception as pydub_error:
-            print(f"Failed to convert audio with pydub: {pydub_error}")
-            print("Returning original audio data as fallback")
-            return audio_data
+            logger.error("Failed to convert audio with pydub: %s - returning original audio data as fallback", pydub_error)
+            return audio_data, False
             
     except Exception as e:
-        print(f"Error in convert_audio_to_pcm: {e}")
+        logger.error("Error in convert_audio_to_pcm: %s", e)
         # Return original data as fallback
-        return audio_data
+        return audio_data, False
+
+# Latency histograms for the hot spans of /tts, reported by /stats. Bucket bounds are
+# in seconds; like Prometheus, percentiles are read off the bucket upper bounds
+# (capped at the largest value seen).
+# Every gunicorn worker keeps its own numbers.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+class LatencyHistogram:
+    """Thread-safe bucketed latency histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot counts anything over the top bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, counts, count, fraction):
+        rank = count * fraction
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                # A bucket bound can overshoot everything observed; the max is a tighter bound
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            counts, count, total, maximum = list(self.counts), self.count, self.sum, self.max
+        if not count:
+            return {"count": 0}
+        return {
+            "count": count,
+            "average_ms": round(total / count * 1000, 1),
+            "p50_ms": round(self.percentile(counts, count, 0.50) * 1000, 1),
+            "p95_ms": round(self.percentile(counts, count, 0.95) * 1000, 1),
+            "p99_ms": round(self.percentile(counts, count, 0.99) * 1000, 1),
+            "max_ms": round(maximum * 1000, 1)
+        }
+
+class Counter:
+    """Thread-safe event counter"""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self):
+        with self._lock:
+            self.value += 1
+
+UPSTREAM_LATENCY = LatencyHistogram()    # Deepdub POST until its response headers arrive
+CONVERSION_LATENCY = LatencyHistogram()  # Buffered audio -> PCM conversion
+CONVERSION_FALLBACKS = Counter()         # Conversions that had to go through pydub
+# Whole /tts request, by X-Cache outcome
+TOTAL_LATENCY = {status: LatencyHistogram() for status in ("MISS", "HIT", "SHARED", "NOT_MODIFIED", "DEMO")}
+
+class DeepdubError(Exception):
+    """Raised when a Deepdub call fails; `payload` is the JSON error body returned to VAPI"""
+
+    def __init__(self, error, **details):
+        super().__init__(error)
+        self.payload = {"error": error, **details}
+
+# In-memory LRU of synthesized PCM keyed by everything that shapes the audio.
+# VAPI agents repeat the same prompts constantly, so hits skip Deepdub entirely.
+TTS_CACHE_SIZE = int(os.getenv("TTS_CACHE_SIZE", 512))
+# Entries vary from a few KB to several MB of PCM, so also cap the total bytes held
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+_tts_cache = OrderedDict()
+_tts_cache_bytes = 0
+_tts_cache_lock = threading.Lock()
+
+def tts_cache_key(text, sample_rate, speed, as_wav=False):
+    """Build a stable cache key; whitespace is collapsed so trivially different texts share an entry"""
+    normalized = " ".join(text.split())
+    raw = f"{VOICE_PROMPT_ID}|{sample_rate}|{speed}|{'wav' if as_wav else 'pcm'}|{normalized}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def tts_cache_get(key):
+    with _tts_cache_lock:
+        pcm_data = _tts_cache.get(key)
+        if pcm_data is not None:
+            _tts_cache.move_to_end(key)
+        return pcm_data
+
+def tts_cache_put(key, pcm_data):
+    global _tts_cache_bytes
+    if TTS_CACHE_SIZE <= 0 or not pcm_data or len(pcm_data) > TTS_CACHE_MAX_BYTES:
+        return
+    with _tts_cache_lock:
+        previous = _tts_cache.pop(key, None)
+        if previous is not None:
+            _tts_cache_bytes -= len(previous)
+        _tts_cache[key] = pcm_data
+        _tts_cache_bytes += len(pcm_data)
+        while len(_tts_cache) > TTS_CACHE_SIZE or _tts_cache_bytes > TTS_CACHE_MAX_BYTES:
+            _, evicted = _tts_cache.popitem(last=False)
+            _tts_cache_bytes -= len(evicted)
+
+# Single-flight: concurrent requests for the same cache key share one Deepdub call.
+# The first request becomes the leader; the rest wait on its Future.
+INFLIGHT_WAIT_TIMEOUT = 30  # seconds; a bit above the Deepdub timeout
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def join_inflight(key):
+    """Return (future, is_leader) for `key`, registering a new future if nobody owns it yet"""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future, False
+        future = Future()
+        _inflight[key] = future
+        return future, True
+
+def finish_inflight(key, future, pcm_data=None, error=None):
+    """Resolve the leader's future and let the next request for `key` start fresh"""
+    if future is None:
+        return
+    with _inflight_lock:
+        if _inflight.get(key) is future:
+            del _inflight[key]
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(pcm_data)
+
+# Response formats in server preference order; WAV only when the client asks for it
+AUDIO_MIMETYPES = ["application/octet-stream", "audio/wav", "audio/x-wav"]
+
+STREAM_CHUNK_SIZE = 4096  # Bytes pulled from Deepdub per read when streaming
+WAV_HEADER_PEEK = 4096    # Bytes buffered before deciding whether a WAV can be streamed as-is
+
+def network_error(req_error):
+    """The DeepdubError for a request to Deepdub that failed at the transport level"""
+    logger.error("Request failed: %s", req_error)
+    return DeepdubError(f"Network error: {str(req_error)}")
+
+def check_for_text_error(audio_data):
+    """Deepdub sometimes answers 200 with a plain-text error instead of audio"""
+    if audio_data.startswith(b'{') or audio_data.startswith(b'['):
+        # Looks like JSON, log it for debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received JSON-like response: %.500s", audio_data.decode('utf-8', errors='ignore'))
+    elif len(audio_data) < 1000 and all(byte < 128 for byte in audio_data[:100]):
+        # Might be a text error message
+        error_text = audio_data.decode('utf-8', errors='ignore')
+        logger.warning("Received text response: %s", error_text)
+        raise DeepdubError(f"Deepdub API returned text error: {error_text}")
+
+class ClosingBody:
+    """
+    Streaming body that runs `on_close` when it's closed, whether or not iteration started.
+
+    A generator's finally block never runs if it's closed before the first chunk is
+    pulled (e.g. VAPI hangs up early), so anything that must always be released - the
+    Deepdub response, queued work - is released here instead of inside the generator.
+    """
+
+    def __init__(self, chunks, on_close, cacheable=True):
+        self._chunks = chunks
+        self._on_close = on_close
+        # False for audio that couldn't be converted, which mustn't be cached or revalidated
+        self.cacheable = cacheable
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def close(self):
+        try:
+            self._chunks.close()
+        finally:
+            self._on_close()
+
+def stream_wav_data(head, wav_info, chunks):
+    """Forward the data chunk of a WAV that's still downloading, starting with the bytes in `head`"""
+    data_offset = wav_info[3]
+    declared_size = struct.unpack_from('<I', head, data_offset - 4)[0]
+    remaining = declared_size if 0 < declared_size < 0xFFFFFFFF else None
+
+    yield bytes(head[data_offset:data_offset + remaining] if remaining else head[data_offset:])
+    if remaining is not None:
+        remaining -= len(head) - data_offset
+    for chunk in chunks:
+        if remaining is not None:
+            if remaining <= 0:
+                break  # Anything after the data chunk isn't audio
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+        yield chunk
+
+def stream_wav_file(head, chunks):
+    """Forward a WAV that's still downloading exactly as Deepdub sent it, header included"""
+    yield bytes(head)
+    yield from chunks
+
+def wav_header(data_size, sample_rate):
+    """44-byte RIFF header for 16-bit mono PCM"""
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b'data', data_size
+    )
+
+def collect_body(r, head, chunks):
+    """
+    Join the rest of a streamed body onto the peeked head.
+
+    When Deepdub sends an exact (unencoded) Content-Length the buffer is allocated once
+    at full size and filled in place, instead of growing and then being copied to bytes.
+    """
+    expected = 0
+    if r.headers.get('content-encoding', 'identity') == 'identity':
+        try:
+            expected = int(r.headers.get('content-length', 0))
+        except ValueError:
+            expected = 0
+
+    if expected <= len(head):
+        for chunk in chunks:
+            head += chunk
+        return head
+
+    audio_data = bytearray(expected)
+    view = memoryview(audio_data)
+    view[:len(head)] = head
+    offset = len(head)
+    for chunk in chunks:
+        end = offset + len(chunk)
+        if end > expected:
+            # More data than advertised - stop filling in place and append the rest
+            view.release()
+            del audio_data[offset:]
+            audio_data += chunk
+            for chunk in chunks:
+                audio_data += chunk
+            return audio_data
+        view[offset:end] = chunk
+        offset = end
+    view.release()
+    del audio_data[offset:]  # Trim if the body came up short
+    return audio_data
+
+def stream_audio_body(r, target_rate, as_wav=False):
+    """
+    Turn a Deepdub audio body into PCM chunks for VAPI.
+
+    A WAV that's already 16-bit mono at target_rate is forwarded while it downloads;
+    anything else is buffered and converted in one go. With as_wav the client takes
+    WAV, so any WAV from Deepdub is forwarded whole and converted audio gets a header.
+    """
+    # Peek at the start of the body to see whether it can be forwarded untouched
+    chunks = r.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+    head = bytearray()
+    try:
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= WAV_HEADER_PEEK:
+                break
+    except requests.exceptions.RequestException as read_error:
+        r.close()
+        raise network_error(read_error)
+
+    # Check for empty response
+    if not head:
+        r.close()
+        logger.error("Empty response from Deepdub API")
+        raise DeepdubError("Empty response from Deepdub API")
+
+    # Log first few bytes as hex for debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("First 32 bytes (hex): %s", bytes(head[:32]).hex())
+
+    wav_info = parse_wav_header(head)
+    if as_wav and wav_info is not None:
+        logger.debug("Client accepts WAV, forwarding Deepdub's WAV untouched")
+        return ClosingBody(stream_wav_file(head, chunks), r.close)
+
+    if wav_info is not None and wav_info[:3] == (1, 2, target_rate):
+        logger.debug("WAV already %dHz 16-bit mono, streaming PCM as it arrives", target_rate)
+        return ClosingBody(stream_wav_data(head, wav_info, chunks), r.close)
+
+    # Needs conversion, so the whole file is required
+    try:
+        audio_data = collect_body(r, head, chunks)
+    except requests.exceptions.RequestException as read_error:
+        raise network_error(read_error)
+    finally:
+        r.close()
+    logger.debug("Audio content length: %d bytes", len(audio_data))
+
+    check_for_text_error(audio_data)
+
+    conversion_start = time.perf_counter()
+    pcm_data, converted = convert_audio_to_pcm(audio_data, target_rate)
+    CONVERSION_LATENCY.observe(time.perf_counter() - conversion_start)
+    logger.debug("Converted to PCM: %d bytes", len(pcm_data))
+    if as_wav:
+        return ClosingBody(single_chunk(wav_header(len(pcm_data), target_rate) + pcm_data), r.close, converted)
+    # A failed conversion hands back collect_body's bytearray, and WSGI servers only
+    # take bytes (bytes() of a bytes object is the same object, so this is free)
+    return ClosingBody(single_chunk(bytes(pcm_data)), r.close, converted)
+
+def stream_from_audio_url(audio_json, sample_rate, as_wav=False):
+    """Download the audio referenced by a JSON (audioUrl) Deepdub response as PCM chunks"""
+    logger.debug("Successfully parsed JSON response, keys: %s",
+                 list(audio_json.keys()) if isinstance(audio_json, dict) else 'Not a dict')
+
+    audio_url = audio_json.get("audioUrl")
+    if not audio_url:
+        raise DeepdubError("Missing audioUrl in Deepdub response")
+
+    # Download audio from Deepdub's audioUrl
+    try:
+        audio_response = HTTP_SESSION.get(audio_url, stream=True, timeout=DEEPDUB_TIMEOUT)
+    except requests.exceptions.RequestException as req_error:
+        raise network_error(req_error)
+    if audio_response.status_code != 200:
+        audio_response.close()
+        raise DeepdubError("Failed to fetch audio from audioUrl")
+
+    return stream_audio_body(audio_response, sample_rate, as_wav)
+
+def single_chunk(pcm_data):
+    yield pcm_data
+
+def stream_from_deepdub(text, sample_rate, speed, as_wav=False):
+    """
+    Call the Deepdub TTS API and return an iterator of raw PCM (or WAV, with as_wav) chunks for VAPI.
+
+    Handles both Deepdub response formats (JSON with audioUrl and direct audio);
+    either way the audio goes through stream_audio_body.
+
+    Raises:
+        DeepdubError: if Deepdub fails before any audio is produced
+    """
+    deepdub_payload = {
+        **DEEPDUB_PAYLOAD_TEMPLATE,
+        "targetText": text,
+        "speed": speed  # Add speed control for faster speech
+    }
+
+    logger.debug("Sending request to Deepdub API %s: %s", DEEPDUB_TTS_URL, deepdub_payload)
+
+    if not _upstream_slots.acquire(timeout=UPSTREAM_WAIT_TIMEOUT):
+        logger.error("Deepdub concurrency limit reached (%d in flight)", UPSTREAM_CONCURRENCY)
+        raise DeepdubError("Too many concurrent Deepdub requests")
+
+    upstream_start = time.perf_counter()
+    try:
+        r = HTTP_SESSION.post(
+            DEEPDUB_TTS_URL,
+            headers=DEEPDUB_HEADERS,
+            json=deepdub_payload,
+            timeout=DEEPDUB_TIMEOUT,
+            stream=True
+        )
+    except requests.exceptions.RequestException as req_error:
+        raise network_error(req_error)
+    finally:
+        _upstream_slots.release()
+        UPSTREAM_LATENCY.observe(time.perf_counter() - upstream_start)
+
+    if r.status_code != 200:
+        logger.error("Deepdub API error: %s | Response content: %s", r.status_code, r.text)
+        logger.debug("Response headers: %s", r.headers)
+        raise DeepdubError(f"Deepdub TTS failed with status {r.status_code}", details=r.text)
+
+    logger.debug("Deepdub API response status: %s, headers: %s", r.status_code, r.headers)
+
+    # Check if response is JSON
+    content_type = r.headers.get('content-type', '').lower()
+    logger.debug("Response content-type: %s", content_type)
+
+    if 'application/json' in content_type:
+        # JSON response with audioUrl (old format)
+        try:
+            audio_json = orjson.loads(r.content) if ORJSON_AVAILABLE else r.json()
+        except ValueError as json_error:
+            logger.error("Failed to parse JSON from Deepdub response: %s | Raw response content: %s", json_error, r.text)
+            raise DeepdubError(f"Invalid JSON response from Deepdub API: {str(json_error)}", raw_response=r.text[:200])
+
+        return stream_from_audio_url(audio_json, sample_rate, as_wav)
+
+    elif 'audio/' in content_type or 'text/plain' in content_type:
+        # Direct audio response (new format) or binary data with text/plain content-type
+        logger.debug("Received direct audio response: %s", content_type)
+        target_rate = DEEPDUB_OUTPUT_RATE  # Force 8000Hz as requested
+
+        return stream_audio_body(r, target_rate, as_wav)
+
+    else:
+        # Unknown response format
+        check_for_text_error(r.content)
+        logger.error("Unexpected content type: %s | Raw response: %.500s", content_type, r.text)
+        raise DeepdubError(f"Deepdub API returned unexpected response type: {content_type}")
+
+def split_sentences(text):
+    """Split text at sentence ends, or return None when it's short enough to send whole"""
+    if not SENTENCE_SPLIT_MIN_CHARS or len(text) < SENTENCE_SPLIT_MIN_CHARS:
+        return None
+    sentences = [sentence for sentence in SENTENCE_END.split(text) if sentence.strip()]
+    return sentences if len(sentences) > 1 else None
+
+def synthesize_sentence(text, sample_rate, speed):
+    chunks = stream_from_deepdub(text, sample_rate, speed)
+    try:
+        if not chunks.cacheable:
+            # Raw compressed audio can't be spliced into the PCM stream
+            raise DeepdubError("Deepdub audio could not be converted to PCM")
+        return b"".join(chunks)
+    finally:
+        chunks.close()
+
+def stream_tts(text, sample_rate, speed, as_wav=False):
+    """
+    Synthesize text as an iterator of audio chunks, pipelining sentence by sentence when it's long.
+
+    WAV output is always one request, since separately synthesized WAV files can't be concatenated.
+
+    Raises:
+        DeepdubError: if Deepdub fails before any audio is produced
+    """
+    sentences = None if as_wav else split_sentences(text)
+    if sentences is None:
+        return stream_from_deepdub(text, sample_rate, speed, as_wav)
+
+    logger.debug("Synthesizing %d sentences, first one streamed", len(sentences))
+    first = stream_from_deepdub(sentences[0], sample_rate, speed)
+    if not first.cacheable:
+        # Unconverted audio can't be joined with the other sentences; send the text whole
+        first.close()
+        return stream_from_deepdub(text, sample_rate, speed)
+    ahead = [_sentence_pool.submit(synthesize_sentence, sentence, sample_rate, speed)
+             for sentence in sentences[1:]]
+
+    def generate():
+        yield from first
+        for future in ahead:
+            yield future.result()
+
+    def abandon():
+        # Client gone or a sentence failed - don't synthesize what nobody will hear
+        first.close()
+        for future in ahead:
+            future.cancel()
+
+    return ClosingBody(generate(), abandon)
+
+def pcm_response(pcm_data, content_type="application/octet-stream", extra_headers=None):
+    """Wrap fully-available PCM (or WAV) bytes in the response VAPI expects.
+
+    direct_passthrough hands the single-element body to the WSGI server as-is
+    instead of routing it through Werkzeug's re-encoding iterator.
+    """
+    headers = {"Content-Length": str(len(pcm_data))}
+    if extra_headers:
+        headers.update(extra_headers)
+    return Response(
+        [pcm_data],
+        content_type=content_type,
+        headers=headers,
+        direct_passthrough=True
+    )
+
+DEMO_DURATION_SECONDS = 2
+
+def generate_demo_pcm(sample_rate, duration_seconds=DEMO_DURATION_SECONDS):
+    """
+    Build the mock audio returned in demo mode: 16-bit mono silence.
+
+    bytes(n) is a single zeroed allocation instead of a Python-level repeat.
+    """
+    frames = int(duration_seconds * sample_rate)
+    return bytes(2 * frames)  # 2 bytes per frame (16-bit)
+
+# The demo payload doesn't depend on the text, so build it for every supported
+# rate at startup and serve demo requests straight from this table
+DEMO_PCM = {rate: generate_demo_pcm(rate) for rate in VALID_SAMPLE_RATES} if DEMO_MODE else {}
+
+def static_json(payload):
+    """Serialize a constant JSON body once, in the same shape jsonify() produces"""
+    return f"{app.json.dumps(payload, separators=(',', ':'))}\n".encode("utf-8")
+
+# Validation failures always send the same bodies, so they're prebuilt instead of
+# going through jsonify() on every rejected request
+UNAUTHORIZED_BODY = static_json({"error": "Unauthorized"})
+MISSING_MESSAGE_BODY = static_json({"error": "Missing message object"})
+INVALID_TYPE_BODY = static_json({"error": "Invalid message type"})
+INVALID_TEXT_BODY = static_json({"error": "Invalid or missing text"})
+TOO_LARGE_BODY = static_json({"error": "Request body too large"})
+BAD_RATE_BODY = static_json({
+    "error": "Unsupported sample rate",
+    "supportedRates": sorted(VALID_SAMPLE_RATES)
+})
+
+def error_response(body, status):
+    return Response(body, status=status, content_type="application/json")
+
+# Synthesis is deterministic for a cache key, so HTTP caches between VAPI and the
+# proxy may keep the audio and revalidate it with If-None-Match. no-transform keeps
+# proxies from gzipping the (incompressible) PCM on the way through, and Vary keeps
+# them from handing WAV to a client that asked for raw PCM (or the reverse).
+TTS_CACHE_CONTROL = "public, max-age=86400, immutable, no-transform"
+# Audio that couldn't be converted is served once but never stored or revalidated
+UNCACHEABLE_HEADERS = {"Cache-Control": "no-store", "X-Cache": "MISS"}
+
+def http_cache_headers(cache_key, cache_status):
+    return {
+        "ETag": f'"{cache_key}"',
+        "Cache-Control": TTS_CACHE_CONTROL,
+        "Vary": "Accept",
+        "X-Cache": cache_status
+    }
+
+def log_tts_request(request_id, text, sample_rate, audio_format, size, start_time, cache_status):
+    """The single INFO line (and total latency sample) written for each served /tts request"""
+    duration = time.time() - start_time
+    TOTAL_LATENCY[cache_status].observe(duration)
+    logger.info("tts req_id=%s text_len=%d sr=%d format=%s bytes=%d dur_ms=%.1f cache=%s",
+                request_id, len(text), sample_rate, audio_format, size,
+                duration * 1000, cache_status)
 
 @app.route("/tts", methods=["POST"])
 def tts():
     request_id = str(uuid.uuid4())
     start_time = time.time()
 
-    if request.headers.get("X-VAPI-SECRET") != VAPI_SECRET:
-        return jsonify({"error": "Unauthorized"}), 401
+    # Constant-time compare so response timing doesn't leak how much of the secret matched
+    provided_secret = request.headers.get("X-VAPI-SECRET", "").encode("utf-8")
+    if not hmac.compare_digest(provided_secret, VAPI_SECRET_BYTES):
+        return error_response(UNAUTHORIZED_BODY, 401)
+
+    if request.content_length is not None and request.content_length > MAX_TTS_BODY_BYTES:
+        return error_response(TOO_LARGE_BODY, 413)
 
-    body = request.get_json()
-    message = body.get("message")
+    # A missing or malformed body gets the same JSON 400 as a body without a message
+    body = request.get_json(silent=True, cache=False)
+    message = body.get("message") if isinstance(body, dict) else None
     if not message:
-        return jsonify({"error": "Missing message object"}), 400
+        return error_response(MISSING_MESSAGE_BODY, 400)
 
     if message.get("type") != "voice-request":
-        return jsonify({"error": "Invalid message type"}), 400
+        return error_response(INVALID_TYPE_BODY, 400)
 
     text = message.get("text", "").strip()
     if not text:
-        return jsonify({"error": "Invalid or missing text"}), 400
+        return error_response(INVALID_TEXT_BODY, 400)
 
     sample_rate = message.get("sampleRate")
-    if sample_rate not in VALID_SAMPLE_RATES:
-        return jsonify({
-            "error": "Unsupported sample rate",
-            "supportedRates": VALID_SAMPLE_RATES
-        }), 400
+    # Integral floats (8000.0) are accepted as before; the int keeps cache keys and
+    # WAV headers identical to an 8000 request
+    if isinstance(sample_rate, float) and sample_rate.is_integer():
+        sample_rate = int(sample_rate)
+    if not isinstance(sample_rate, int) or sample_rate not in VALID_SAMPLE_RATES:
+        return error_response(BAD_RATE_BODY, 400)
 
     # Set default speed to 1.3 for slightly faster, more natural speech
     # Since VAPI doesn't send speed parameter, we use a faster default
     speed = 1.3  # 30% faster than normal speed
 
-    print(f"TTS request started: {request_id} | Text length: {len(text)} | Sample rate: {sample_rate}Hz | Speed: {speed}x")
-    print(f"Request text: '{text}'")
-    print(f"DEMO_MODE: {DEMO_MODE}")
-    print(f"API Key present: {bool(DEEPDUB_API_KEY)}")
-    print(f"Voice Prompt ID present: {bool(VOICE_PROMPT_ID)}")
+    # Raw PCM unless the client explicitly prefers WAV, which lets Deepdub's WAV through untouched
+    content_type = request.accept_mimetypes.best_match(AUDIO_MIMETYPES) or "application/octet-stream"
+    as_wav = content_type != "application/octet-stream"
+
+    audio_format = "wav" if as_wav else "pcm"
+    logger.debug("TTS request started: %s | Text length: %d | Sample rate: %dHz | Speed: %sx | Format: %s",
+                 request_id, len(text), sample_rate, speed, audio_format)
+    logger.debug("Request text: '%s'", text)
 
     # Check if required environment variables are set (unless in demo mode)
     if not DEMO_MODE:
         if not DEEPDUB_API_KEY:
-            print(f"TTS failed: {request_id} | Missing DEEPDUB_API_KEY")
+            logger.error("TTS failed: %s | Missing DEEPDUB_API_KEY", request_id)
             return jsonify({"error": "Server configuration error: Missing API key"}), 500
         
         if not VOICE_PROMPT_ID:
-            print(f"TTS failed: {request_id} | Missing DEEPDUB_VOICE_PROMPT_ID")
+            logger.error("TTS failed: %s | Missing DEEPDUB_VOICE_PROMPT_ID", request_id)
             return jsonify({"error": "Server configuration error: Missing voice prompt ID"}), 500
 
     try:
         if DEMO_MODE:
             # Demo mode: return a simple mock audio response
-            print(f"TTS completed (DEMO): {request_id} | Duration: {time.time() - start_time:.2f}s")
-            
-            # Create a simple mock PCM audio (silence)
-            duration = 2.0  # 2 seconds
-            frames = int(duration * sample_rate)
-            
-            # Create raw PCM data (16-bit mono silence)
-            pcm_data = b'\x00\x00' * frames  # 2 bytes per frame (16-bit)
-            
-            return Response(
-                pcm_data,
-                content_type="application/octet-stream",
-                headers={
-                    "Content-Length": str(len(pcm_data))
-                }
-            )
+            pcm_data = DEMO_PCM[sample_rate]
+            log_tts_request(request_id, text, sample_rate, audio_format, len(pcm_data), start_time, "DEMO")
+            if as_wav:
+                return pcm_response(wav_header(len(pcm_data), sample_rate) + pcm_data, content_type)
+            return pcm_response(pcm_data)
         else:
-            # Real mode: Call Deepdub TTS
-            deepdub_payload = {
-                "model": "dd-etts-2.5",
-                "targetText": text,
-                "locale": "he-IL",
-                "voicePromptId": VOICE_PROMPT_ID,
-                "speed": speed  # Add speed control for faster speech
-            }
-            
-            print(f"Sending request to Deepdub API: {deepdub_payload}")
-            print(f"Using API Key: {DEEPDUB_API_KEY[:10]}...")
-            print(f"API URL: https://restapi.deepdub.ai/tts")
-            
-            try:
-                r = requests.post(
-                    "https://restapi.deepdub.ai/tts",
-                    headers={
-                        "Content-Type": "application/json",
-                        "x-api-key": DEEPDUB_API_KEY
-                    },
-                    json=deepdub_payload,
-                    timeout=25
-                )
-            except requests.exceptions.RequestException as req_error:
-                print(f"Request failed: {req_error}")
-                return jsonify({"error": f"Network error: {str(req_error)}"}), 500
-
-            if r.status_code != 200:
-                print(f"Deepdub API error: {r.status_code}")
-                print(f"Response headers: {dict(r.headers)}")
-                print(f"Response content: {r.text}")
-                return jsonify({
-                    "error": f"Deepdub TTS failed with status {r.status_code}",
-                    "details": r.text
-                }), 500
-
-            print(f"Deepdub API response status: {r.status_code}")
-            print(f"Deepdub API response headers: {dict(r.headers)}")
-            print(f"Response content length: {len(r.content)} bytes")
-            
-            # Check for empty response
-            if not r.content:
-                print("ERROR: Empty response from Deepdub API")
-                return jsonify({"error": "Empty response from Deepdub API"}), 500
-            
-            # Log first few bytes as hex for debugging
-            print(f"First 32 bytes (hex): {r.content[:32].hex() if len(r.content) >= 32 else r.content.hex()}")
-            
-            # Try to detect if it's actually text/error response
+            # Real mode: serve from cache when we've already synthesized this exact request
+            cache_key = tts_cache_key(text, sample_rate, speed, as_wav)
+            # Match the actual ETag only; contains_weak() would also accept "*" for
+            # texts this proxy has never synthesized
+            if_none_match = request.if_none_match
+            if not if_none_match.star_tag and if_none_match.contains_weak(cache_key):
+                # The client already holds this exact audio. RFC 9110 13.1.2 says a failed
+                # If-None-Match on a POST gets 412, but /tts is a POST only because VAPI puts
+                # the text in a JSON body - it reads audio like a GET would, and a 304 tells
+                # the client to play its stored copy where a 412 would look like an error
+                log_tts_request(request_id, text, sample_rate, audio_format, 0, start_time, "NOT_MODIFIED")
+                return Response(status=304, headers=http_cache_headers(cache_key, "HIT"))
+
+            pcm_data = tts_cache_get(cache_key)
+            inflight, is_leader = None, True
+            cache_status = "HIT"
+
+            if pcm_data is None:
+                # Someone may already be synthesizing this exact text - wait for their result
+                inflight, is_leader = join_inflight(cache_key)
+                if not is_leader:
+                    logger.debug("TTS joining in-flight synthesis: %s", request_id)
+                    cache_status = "SHARED"
+                    try:
+                        pcm_data = inflight.result(timeout=INFLIGHT_WAIT_TIMEOUT)
+                    except Exception as inflight_error:
+                        # The leader failed or is taking too long, synthesize ourselves
+                        logger.warning("In-flight synthesis unavailable: %s | %s", request_id, inflight_error)
+
+            if pcm_data is not None:
+                log_tts_request(request_id, text, sample_rate, audio_format, len(pcm_data), start_time, cache_status)
+                return pcm_response(pcm_data, content_type, http_cache_headers(cache_key, cache_status))
+
+            if not is_leader:
+                inflight = None
+
             try:
-                if r.content.startswith(b'{') or r.content.startswith(b'['):
-                    # Looks like JSON, try to parse for error info
-                    error_text = r.content.decode('utf-8', errors='ignore')
-                    print(f"Received JSON-like response: {error_text[:500]}")
-                elif len(r.content) < 1000 and all(byte < 128 for byte in r.content[:100]):
-                    # Might be a text error message
-                    error_text = r.content.decode('utf-8', errors='ignore')
-                    print(f"Received text response: {error_text}")
-                    return jsonify({"error": f"Deepdub API returned text error: {error_text}"}), 500
-            except Exception as decode_error:
-                print(f"Could not decode response as text: {decode_error}")
-                # Continue with binary processing
-            
-            # Check if response is JSON
-            content_type = r.headers.get('content-type', '').lower()
-            print(f"Response content-type: {content_type}")
-            
-            if 'application/json' in content_type:
-                # JSON response with audioUrl (old format)
+                pcm_chunks = stream_tts(text, sample_rate, speed, as_wav)
+            except DeepdubError as deepdub_error:
+                finish_inflight(cache_key, inflight, error=deepdub_error)
+                return jsonify(deepdub_error.payload), 500
+            except Exception as synthesis_error:
+                # Resolve the future whatever went wrong, or identical requests would keep
+                # waiting out INFLIGHT_WAIT_TIMEOUT on an entry nobody will ever finish
+                finish_inflight(cache_key, inflight, error=synthesis_error)
+                raise
+
+            cacheable = pcm_chunks.cacheable
+
+            def generate():
+                # Keep a copy of what we send so the full utterance can be cached at the end
+                pcm_buffer = bytearray()
                 try:
-                    audio_json = r.json()
-                    print(f"Successfully parsed JSON response")
-                    print(f"JSON keys: {list(audio_json.keys()) if isinstance(audio_json, dict) else 'Not a dict'}")
-                    
-                    audio_url = audio_json.get("audioUrl")
-                    if not audio_url:
-                        return jsonify({"error": "Missing audioUrl in Deepdub response"}), 500
-
-                    # Download audio from Deepdub's audioUrl
-                    audio_response = requests.get(audio_url, stream=True)
-                    if audio_response.status_code != 200:
-                        return jsonify({"error": "Failed to fetch audio from audioUrl"}), 500
-
-                    # Get the audio data
-                    audio_data = audio_response.content
-                    print(f"Downloaded audio data: {len(audio_data)} bytes")
-                    
-                    # Convert to PCM
-                    pcm_data = convert_audio_to_pcm(audio_data, sample_rate)
-                    print(f"Converted to PCM: {len(pcm_data)} bytes")
-
-                    print(f"TTS completed: {request_id} | Duration: {time.time() - start_time:.2f}s")
-
-                    return Response(
-                        pcm_data,
-                        content_type="application/octet-stream",
-                        headers={
-                            "Content-Length": str(len(pcm_data))
-                        }
-                    )
-                    
-                except ValueError as json_error:
-                    print(f"Failed to parse JSON from Deepdub response: {json_error}")
-                    print(f"Raw response content: {r.text}")
-                    return jsonify({"error": f"Invalid JSON response from Deepdub API: {str(json_error)}", "raw_response": r.text[:200]}), 500
-                    
-            elif 'audio/' in content_type or 'text/plain' in content_type:
-                # Direct audio response (new format) or binary data with text/plain content-type
-                print(f"Received direct audio response: {content_type}")
-                print(f"Audio content length: {len(r.content)} bytes")
-                
-                # Convert to PCM at 8000Hz
-                pcm_data = convert_audio_to_pcm(r.content, 8000)  # Force 8000Hz as requested
-                print(f"Converted to PCM: {len(pcm_data)} bytes")
-                
-                print(f"TTS completed: {request_id} | Duration: {time.time() - start_time:.2f}s")
-                
-                # Return the PCM data
-                return Response(
-                    pcm_data,
-                    content_type="application/octet-stream",
-                    headers={
-                        "Content-Length": str(len(pcm_data))
-                    }
-                )
-            else:
-                # Unknown response format
-                print(f"ERROR: Unexpected content type: {content_type}")
-                print(f"Raw response: {r.text[:500]}")
-                return jsonify({"error": f"Deepdub API returned unexpected response type: {content_type}"}), 500
+                    for chunk in pcm_chunks:
+                        pcm_buffer += chunk
+                        yield chunk
+
+                    pcm_data = bytes(pcm_buffer)
+                    if cacheable:
+                        tts_cache_put(cache_key, pcm_data)
+                        finish_inflight(cache_key, inflight, pcm_data=pcm_data)
+                    else:
+                        # Waiters try Deepdub themselves rather than share unconverted audio
+                        finish_inflight(cache_key, inflight, error=DeepdubError("Deepdub audio could not be converted"))
+                    log_tts_request(request_id, text, sample_rate, audio_format, len(pcm_data), start_time, "MISS")
+                except Exception as stream_error:
+                    logger.error("TTS stream aborted: %s | Error: %s", request_id, stream_error)
+                    raise
+                finally:
+                    release()
+
+            def release():
+                pcm_chunks.close()
+                # Never leave waiters hanging if the client disconnected or Deepdub broke mid-stream
+                if inflight is not None and not inflight.done():
+                    finish_inflight(cache_key, inflight, error=RuntimeError("Stream did not complete"))
+
+            # No Content-Length: the audio goes out with chunked transfer encoding as it arrives
+            return Response(
+                ClosingBody(generate(), release),
+                content_type=content_type,
+                headers=http_cache_headers(cache_key, "MISS") if cacheable else UNCACHEABLE_HEADERS,
+                direct_passthrough=True
+            )
 
     except Exception as e:
-        print(f"TTS failed: {request_id} | Error: {str(e)}")
+        logger.error("TTS failed: %s | Error: %s", request_id, e)
         return jsonify({"error": f"TTS synthesis failed", "requestId": request_id}), 500
 
+# DEMO_MODE is fixed at startup, so the status page is too
+ROOT_BODY = "Deepdub TTS Proxy with streaming is running. " + ("🎭 DEMO MODE" if DEMO_MODE else "🚀 PRODUCTION MODE")
+
 @app.route("/")
 def root():
-    status = "🎭 DEMO MODE" if DEMO_MODE else "🚀 PRODUCTION MODE"
-    return f"Deepdub TTS Proxy with streaming is running. {status}"
+    return ROOT_BODY
+
+def library_available(loader, *modules):
+    """
+    What `loader` found if it has already run, otherwise whether `modules` are installed.
+
+    find_spec() only looks for the modules, so /stats never pays for (or triggers)
+    the imports and pydub probe that the loaders defer until audio needs them.
+    """
+    if loader.cache_info().currsize:
+        return loader() is not None
+    return all(importlib.util.find_spec(module) is not None for module in modules)
+
+@app.route("/stats")
+def stats():
+    """Per-worker latency and conversion numbers (see deploy.md)"""
+    conversions = CONVERSION_LATENCY.snapshot()
+    fallbacks = CONVERSION_FALLBACKS.value
+    return jsonify({
+        "latency": {
+            "upstream": UPSTREAM_LATENCY.snapshot(),
+            "total": {status: histogram.snapshot() for status, histogram in TOTAL_LATENCY.items()}
+        },
+        "audio_conversion": {
+            "total_conversions": conversions["count"],
+            "average_time_ms": conversions.get("average_ms", 0),
+            "p95_time_ms": conversions.get("p95_ms", 0),
+            "fast_method_used": conversions["count"] - fallbacks,
+            "fallback_method_used": fallbacks
+        },
+        "libraries": {
+            "numpy_available": library_available(load_numpy, "numpy"),
+            "soundfile_available": library_available(load_native_decoder, "numpy", "soundfile", "scipy"),
+            "pydub_available": library_available(load_pydub, "pydub"),
+            "orjson_available": ORJSON_AVAILABLE
+        },
+        "worker_pid": os.getpid()
+    })
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
@@ -3,9 +3,12 @@
 Test script to debug Deepdub API issues
 """
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 from dotenv import load_dotenv
 import os
+import sys
 
 # Load environment variables
 load_dotenv()
@@ -13,65 +16,84 @@ load_dotenv()
 DEEPDUB_API_KEY = os.getenv("DEEPDUB_API_KEY")
 VOICE_PROMPT_ID = os.getenv("DEEPDUB_VOICE_PROMPT_ID")
 
-print("=== Deepdub API Test ===")
-print(f"API Key: {DEEPDUB_API_KEY[:10]}..." if DEEPDUB_API_KEY else "No API Key")
-print(f"Voice Prompt ID: {VOICE_PROMPT_ID}")
-
-if not DEEPDUB_API_KEY:
-    print("ERROR: No API key found!")
-    exit(1)
-
-if not VOICE_PROMPT_ID:
-    print("ERROR: No voice prompt ID found!")
-    exit(1)
-
-# Test payload
-payload = {
-    "model": "dd-etts-1.1",
-    "targetText": "שלום מה שלומך היום?",
-    "locale": "he-IL",
-    "voicePromptId": VOICE_PROMPT_ID
-}
-
-headers = {
-    "Content-Type": "application/json",
-    "x-api-key": DEEPDUB_API_KEY
-}
-
-print("\n=== Making API Request ===")
-print(f"URL: https://restapi.deepdub.ai/tts")
-print(f"Headers: {headers}")
-print(f"Payload: {json.dumps(payload, ensure_ascii=False, indent=2)}")
-
-try:
-    response = requests.post(
-        "https://restapi.deepdub.ai/tts",
-        headers=headers,
-        json=payload,
-        timeout=30
-    )
-    
-    print(f"\n=== Response ===")
-    print(f"Status Code: {response.status_code}")
-    print(f"Headers: {dict(response.headers)}")
-    print(f"Content Length: {len(response.text)}")
-    print(f"Raw Content: {response.text}")
-    
-    if response.status_code == 200:
-        try:
-            json_response = response.json()
-            print(f"JSON Response: {json.dumps(json_response, indent=2)}")
-            
-            audio_url = json_response.get("audioUrl")
-            if audio_url:
-                print(f"Audio URL: {audio_url}")
-                print("✅ SUCCESS: API call worked!")
-            else:
-                print("❌ ERROR: No audioUrl in response")
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON Decode Error: {e}")
-    else:
-        print(f"❌ API Error: {response.status_code}")
-        
-except requests.exceptions.RequestException as e:
-    print(f"❌ Request Error: {e}")
+# Ride out transient upstream failures; after the last attempt the final response is
+# still returned (raise_on_status=False) so its status and body get printed below
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset({"GET", "POST"}),
+    raise_on_status=False
+)))
+
+def run():
+    """Make one raw Deepdub request and print everything about it; returns the exit status"""
+    print("=== Deepdub API Test ===")
+    print(f"API Key: {DEEPDUB_API_KEY[:10]}..." if DEEPDUB_API_KEY else "No API Key")
+    print(f"Voice Prompt ID: {VOICE_PROMPT_ID}")
+
+    if not DEEPDUB_API_KEY:
+        print("ERROR: No API key found!")
+        return 1
+
+    if not VOICE_PROMPT_ID:
+        print("ERROR: No voice prompt ID found!")
+        return 1
+
+    # Test payload
+    payload = {
+        "model": "dd-etts-1.1",
+        "targetText": "שלום מה שלומך היום?",
+        "locale": "he-IL",
+        "voicePromptId": VOICE_PROMPT_ID
+    }
+
+    headers = {
+        "Content-Type": "application/json",
+        "x-api-key": DEEPDUB_API_KEY
+    }
+
+    print("\n=== Making API Request ===")
+    print(f"URL: https://restapi.deepdub.ai/tts")
+    print(f"Headers: {headers}")
+    print(f"Payload: {json.dumps(payload, ensure_ascii=False, indent=2)}")
+
+    try:
+        response = SESSION.post(
+            "https://restapi.deepdub.ai/tts",
+            headers=headers,
+            json=payload,
+            timeout=30
+        )
+
+        print(f"\n=== Response ===")
+        print(f"Status Code: {response.status_code}")
+        print(f"Headers: {dict(response.headers)}")
+        print(f"Content Length: {len(response.text)}")
+        print(f"Raw Content: {response.text}")
+
+        if response.status_code == 200:
+            try:
+                json_response = response.json()
+                print(f"JSON Response: {json.dumps(json_response, indent=2)}")
+
+                audio_url = json_response.get("audioUrl")
+                if audio_url:
+                    print(f"Audio URL: {audio_url}")
+                    print("✅ SUCCESS: API call worked!")
+                    return 0
+                else:
+                    print("❌ ERROR: No audioUrl in response")
+            except json.JSONDecodeError as e:
+                print(f"❌ JSON Decode Error: {e}")
+        else:
+            print(f"❌ API Error: {response.status_code}")
+
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Request Error: {e}")
+
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(run())
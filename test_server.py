@@ -4,104 +4,184 @@ Quick test script for the optimized TTS proxy
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import argparse
 import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+    dumps = orjson.dumps
+except ImportError:
+    def dumps(payload):
+        return json.dumps(payload, ensure_ascii=False).encode("utf-8")
 
 # Test configuration
 BASE_URL = "http://localhost:5000"  # Change to your Render URL when deployed
 VAPI_SECRET = "deepdub-secret-2025"  # Change to your actual secret
 
+# One keep-alive session for every check, so only the first request pays the TCP/TLS setup
+SESSION = requests.Session()
+ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2))
+SESSION.mount("http://", ADAPTER)
+SESSION.mount("https://", ADAPTER)
+
+# The TTS request never changes, so its headers and body are built once
+TTS_URL = f"{BASE_URL}/tts"
+TTS_HEADERS = {
+    "Content-Type": "application/json",
+    "X-VAPI-SECRET": VAPI_SECRET
+}
+TTS_BODY = dumps({
+    "message": {
+        "type": "voice-request",
+        "text": "שלום, זה בדיקה של המערכת החדשה",
+        "sampleRate": 8000
+    }
+})
+
+# Tests run concurrently, so each one prints its lines in a single block
+print_lock = threading.Lock()
+
+def report(lines):
+    with print_lock:
+        print("\n".join(lines) + "\n")
+
 def test_health():
     """Test basic health endpoint"""
-    print("🔍 Testing health endpoint...")
+    lines = ["🔍 Testing health endpoint..."]
     try:
-        response = requests.get(f"{BASE_URL}/")
-        print(f"✅ Health check: {response.status_code} - {response.text}")
+        response = SESSION.get(f"{BASE_URL}/")
+        lines.append(f"✅ Health check: {response.status_code} - {response.text}")
         return True
     except Exception as e:
-        print(f"❌ Health check failed: {e}")
+        lines.append(f"❌ Health check failed: {e}")
         return False
+    finally:
+        report(lines)
 
 def test_stats():
     """Test performance stats endpoint"""
-    print("📊 Testing stats endpoint...")
+    lines = ["📊 Testing stats endpoint..."]
     try:
-        response = requests.get(f"{BASE_URL}/stats")
+        response = SESSION.get(f"{BASE_URL}/stats")
         if response.status_code == 200:
             stats = response.json()
-            print("✅ Stats endpoint working:")
-            print(f"   Libraries: {stats.get('libraries', {})}")
+            lines.append("✅ Stats endpoint working:")
+            lines.append(f"   Libraries: {stats.get('libraries', {})}")
             if 'audio_conversion' in stats:
                 conv = stats['audio_conversion']
-                print(f"   Conversions: {conv.get('total_conversions', 0)}")
-                print(f"   Avg time: {conv.get('average_time_ms', 0)}ms")
+                lines.append(f"   Conversions: {conv.get('total_conversions', 0)}")
+                lines.append(f"   Avg time: {conv.get('average_time_ms', 0)}ms")
             return True
         else:
-            print(f"❌ Stats failed: {response.status_code}")
+            lines.append(f"❌ Stats failed: {response.status_code}")
             return False
     except Exception as e:
-        print(f"❌ Stats test failed: {e}")
+        lines.append(f"❌ Stats test failed: {e}")
         return False
+    finally:
+        report(lines)
+
+def post_tts(body=TTS_BODY):
+    """POST one TTS request; returns (response, body bytes, ns to first byte, ns to last byte)"""
+    start_time = time.perf_counter_ns()
+    with SESSION.post(TTS_URL, data=body, headers=TTS_HEADERS, stream=True) as response:
+        audio = bytearray()
+        first_byte_time = None
+        for chunk in response.iter_content(chunk_size=4096):
+            if first_byte_time is None:
+                first_byte_time = time.perf_counter_ns()
+            audio += chunk
+    end_time = time.perf_counter_ns()
+    return response, audio, (first_byte_time or end_time) - start_time, end_time - start_time
 
 def test_tts():
-    """Test TTS conversion"""
-    print("🎤 Testing TTS conversion...")
-    
-    payload = {
-        "message": {
-            "type": "voice-request",
-            "text": "שלום, זה בדיקה של המערכת החדשה",
-            "sampleRate": 8000
-        }
-    }
-    
-    headers = {
-        "Content-Type": "application/json",
-        "X-VAPI-SECRET": VAPI_SECRET
-    }
+    """Test TTS conversion, timing the first audio byte separately from the whole response"""
+    lines = ["🎤 Testing TTS conversion..."]
     
     try:
-        start_time = time.time()
-        response = requests.post(f"{BASE_URL}/tts", json=payload, headers=headers)
-        end_time = time.time()
+        response, audio, ttfb, duration = post_tts()
         
         if response.status_code == 200:
-            duration = (end_time - start_time) * 1000
-            content_length = len(response.content)
-            print(f"✅ TTS success: {content_length} bytes in {duration:.1f}ms")
-            print(f"   Content-Type: {response.headers.get('content-type', 'unknown')}")
+            lines.append(f"✅ TTS success: {len(audio)} bytes, first byte in {ttfb / 1e6:.1f}ms, complete in {duration / 1e6:.1f}ms")
+            lines.append(f"   Content-Type: {response.headers.get('content-type', 'unknown')}")
+            lines.append(f"   X-Cache: {response.headers.get('x-cache', 'n/a')}")
             return True
         else:
-            print(f"❌ TTS failed: {response.status_code}")
+            lines.append(f"❌ TTS failed: {response.status_code}")
             try:
-                error_data = response.json()
-                print(f"   Error: {error_data.get('error', 'Unknown error')}")
+                error_data = json.loads(audio)
+                lines.append(f"   Error: {error_data.get('error', 'Unknown error')}")
             except:
-                print(f"   Response: {response.text[:200]}")
+                lines.append(f"   Response: {audio[:200].decode('utf-8', errors='replace')}")
             return False
     except Exception as e:
-        print(f"❌ TTS test failed: {e}")
+        lines.append(f"❌ TTS test failed: {e}")
         return False
+    finally:
+        report(lines)
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def run_load(total, concurrency, uncached=False):
+    """Fire `total` TTS requests with at most `concurrency` in flight and print latency percentiles"""
+    print(f"🔥 Load test: {total} requests, {concurrency} concurrent{' (uncached texts)' if uncached else ''}")
+    # Room in the pool for every in-flight request, so none of them opens a throwaway connection
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(16, concurrency), max_retries=Retry(total=2, backoff_factor=0.2))
+    SESSION.mount("http://", adapter)
+    SESSION.mount("https://", adapter)
+
+    def one(index):
+        body = TTS_BODY
+        if uncached:
+            # A distinct text per request so the proxy's cache can't answer it
+            body = dumps({"message": {"type": "voice-request", "text": f"בדיקת עומס מספר {index}", "sampleRate": 8000}})
+        try:
+            return post_tts(body)
+        except requests.exceptions.RequestException:
+            return None
+
+    wall_start = time.perf_counter_ns()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    wall_time = (time.perf_counter_ns() - wall_start) / 1e9
+
+    ok = [result for result in results if result is not None and result[0].status_code == 200]
+    print(f"   {len(ok)}/{total} succeeded in {wall_time:.2f}s ({total / wall_time:.1f} req/s)")
+    if not ok:
+        return
+
+    ttfbs = sorted(result[2] / 1e6 for result in ok)
+    totals = sorted(result[3] / 1e6 for result in ok)
+    for name, values in (("TTFB", ttfbs), ("Total", totals)):
+        print(f"   {name}: avg {sum(values) / len(values):.1f}ms | p50 {percentile(values, 0.50):.1f}ms | "
+              f"p99 {percentile(values, 0.99):.1f}ms")
+    # Real-time factor: time to produce the audio over its playback length (16-bit mono at 8kHz)
+    rtfs = sorted(result[3] / 1e9 / (len(result[1]) / 16000) for result in ok if result[1])
+    if rtfs:
+        print(f"   RTF: avg {sum(rtfs) / len(rtfs):.3f} | p50 {percentile(rtfs, 0.50):.3f} | p99 {percentile(rtfs, 0.99):.3f}")
+    cache = {}
+    for result in ok:
+        status = result[0].headers.get("x-cache", "n/a")
+        cache[status] = cache.get(status, 0) + 1
+    print(f"   X-Cache: {cache}")
 
 def main():
     """Run all tests"""
     print("🚀 Testing Optimized Deepdub TTS Proxy")
     print("=" * 50)
     
-    success_count = 0
+    # The checks are independent, so health and stats run while TTS is synthesizing
+    tests = (test_health, test_stats, test_tts)
+    with ThreadPoolExecutor(max_workers=len(tests)) as pool:
+        results = list(pool.map(lambda test: test(), tests))
+    success_count = sum(results)
     
-    if test_health():
-        success_count += 1
-    
-    print()
-    if test_stats():
-        success_count += 1
-    
-    print()
-    if test_tts():
-        success_count += 1
-    
-    print()
     print("=" * 50)
     print(f"📋 Results: {success_count}/3 tests passed")
     
@@ -110,7 +190,7 @@ def main():
         
         # Get final stats
         try:
-            response = requests.get(f"{BASE_URL}/stats")
+            response = SESSION.get(f"{BASE_URL}/stats")
             if response.status_code == 200:
                 stats = response.json()
                 if 'audio_conversion' in stats:
@@ -123,4 +203,13 @@ def main():
         print("⚠️  Some tests failed. Check the configuration and try again.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Smoke-test (or load-test) a running TTS proxy")
+    parser.add_argument("--load", type=int, metavar="N", help="send N TTS requests and report latency percentiles instead")
+    parser.add_argument("--concurrency", type=int, default=4, metavar="C", help="requests in flight during --load (default: 4)")
+    parser.add_argument("--uncached", action="store_true", help="use a distinct text per --load request to bypass the proxy cache")
+    args = parser.parse_args()
+
+    if args.load:
+        run_load(args.load, args.concurrency, args.uncached)
+    else:
+        main()
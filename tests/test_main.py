@@ -0,0 +1,368 @@
+"""
+Unit tests for the proxy in main.py.
+
+Deepdub is never called: HTTP_SESSION.post/get are replaced with a fake that serves
+canned bodies, so the WAV handling, caching and single-flight paths run for real.
+"""
+
+import functools
+import io
+import os
+import struct
+import threading
+import time
+import wave
+
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# main reads its configuration at import time
+os.environ.update(
+    DEEPDUB_API_KEY="test-api-key",
+    DEEPDUB_VOICE_PROMPT_ID="test-voice",
+    VAPI_SECRET="test-secret",
+    DEMO_MODE="false",
+    DEEPDUB_WARMUP="false"
+)
+
+import main  # noqa: E402
+
+AUTH = {"X-VAPI-SECRET": "test-secret"}
+UNDECODABLE_MP3 = b"\xff\xfb" + bytes(2000)  # MP3 frame sync, but nothing decodable
+
+
+def make_wav(frames=800, rate=8000, channels=1, sample_width=2):
+    """A WAV written by the wave module, filled with a sawtooth so every frame differs"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(bytes(i % 251 for i in range(frames * channels * sample_width)))
+    return buffer.getvalue()
+
+
+def riff(*chunks, fmt_tag=1, channels=1, rate=8000, bits=16):
+    """Build a RIFF/WAVE file by hand: a fmt chunk followed by (chunk_id, size, body) chunks"""
+    block_align = channels * bits // 8
+    fmt = struct.pack("<HHIIHH", fmt_tag, channels, rate, rate * block_align, block_align, bits)
+    body = b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+    for chunk_id, size, data in chunks:
+        body += chunk_id + struct.pack("<I", size) + data
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+class FakeResponse:
+    """Just enough of requests.Response for the proxy's streaming code"""
+
+    def __init__(self, content, content_type="audio/wav", status_code=200, content_length=True):
+        self.content = content
+        self.status_code = status_code
+        self.text = content.decode("latin-1")
+        self.headers = CaseInsensitiveDict({"Content-Type": content_type})
+        if content_length:
+            self.headers["Content-Length"] = str(len(content))
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDeepdub:
+    """Stands in for HTTP_SESSION; `body` (or `error`) decides what the next POST gets"""
+
+    def __init__(self):
+        self.body = make_wav()
+        self.content_type = "audio/wav"
+        self.error = None
+        self.delay = 0
+        self.calls = 0
+        self.responses = []
+        self._lock = threading.Lock()
+
+    def post(self, url, **kwargs):
+        with self._lock:
+            self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        response = FakeResponse(self.body, self.content_type)
+        self.responses.append(response)
+        return response
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    """Every test starts with an empty cache and no in-flight syntheses"""
+    monkeypatch.setattr(main, "_tts_cache", main.OrderedDict())
+    monkeypatch.setattr(main, "_tts_cache_bytes", 0)
+    monkeypatch.setattr(main, "_inflight", {})
+
+
+@pytest.fixture
+def deepdub(monkeypatch):
+    fake = FakeDeepdub()
+    monkeypatch.setattr(main.HTTP_SESSION, "post", fake.post)
+    return fake
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def post_tts(client, text="shalom", sample_rate=8000, headers=None, **kwargs):
+    payload = {"message": {"type": "voice-request", "text": text, "sampleRate": sample_rate}}
+    return client.post("/tts", json=payload, headers={**AUTH, **(headers or {})}, **kwargs)
+
+
+# WAV header parsing
+
+def test_parse_wav_header_reads_wave_module_output():
+    audio = make_wav(frames=800, rate=16000, channels=2)
+    assert main.parse_wav_header(audio) == (2, 2, 16000, 44, 3200)
+
+
+def test_parse_wav_header_skips_chunks_before_data():
+    # An odd-sized LIST chunk is padded to a word boundary before the data chunk
+    audio = riff((b"LIST", 3, b"abc\x00"), (b"data", 4, b"\x01\x02\x03\x04"))
+    channels, sample_width, framerate, data_offset, data_size = main.parse_wav_header(audio)
+    assert (channels, sample_width, framerate, data_size) == (1, 2, 8000, 4)
+    assert audio[data_offset:data_offset + data_size] == b"\x01\x02\x03\x04"
+
+
+@pytest.mark.parametrize("placeholder", [0, 0xFFFFFFFF])
+def test_parse_wav_header_placeholder_size_covers_available_data(placeholder):
+    audio = riff((b"data", placeholder, b"\x00" * 10))
+    assert main.parse_wav_header(audio)[4] == 10
+
+
+@pytest.mark.parametrize("audio", [
+    b"",
+    b"RIFF\x00\x00\x00\x00WAVE",                         # no chunks at all
+    riff((b"data", 4, b"\x00" * 4), fmt_tag=3),           # IEEE float
+    b"RIFF\x24\x00\x00\x00WAVEdata\x04\x00\x00\x00\x00",  # data before fmt
+    make_wav()[:30],                                      # fmt chunk cut short
+])
+def test_parse_wav_header_rejects_layouts_it_cannot_stream(audio):
+    assert main.parse_wav_header(audio) is None
+
+
+# Streaming WAV data
+
+def test_stream_wav_data_stops_at_declared_size():
+    audio = riff((b"data", 6, b"abcdef"), (b"LIST", 4, b"tags"))
+    head, rest = audio[:46], audio[46:]
+    chunks = main.stream_wav_data(head, main.parse_wav_header(head), iter([rest[i:i + 2] for i in range(0, len(rest), 2)]))
+    assert b"".join(chunks) == b"abcdef"
+
+
+def test_stream_wav_data_placeholder_size_forwards_everything():
+    audio = riff((b"data", 0xFFFFFFFF, b"abcd"))
+    head = audio[:46]
+    chunks = main.stream_wav_data(head, main.parse_wav_header(head), iter([audio[46:], b"ef", b"gh"]))
+    assert b"".join(chunks) == b"abcdefgh"
+
+
+# Buffering bodies that need conversion
+
+@pytest.mark.parametrize("advertised", [None, 6, 10, 20])
+def test_collect_body_matches_the_streamed_bytes(advertised):
+    response = FakeResponse(b"", content_length=False)
+    if advertised is not None:
+        response.headers["Content-Length"] = str(advertised)
+    body = main.collect_body(response, bytearray(b"head"), iter([b"0123", b"4567", b"89"]))
+    assert bytes(body) == b"head0123456789"
+
+
+# Audio conversion
+
+def test_convert_audio_to_pcm_downmixes_and_resamples_wav():
+    pcm, converted = main.convert_audio_to_pcm(make_wav(frames=1600, rate=16000, channels=2), 8000)
+    assert converted
+    assert len(pcm) == 1600  # 800 mono 16-bit frames
+
+
+def test_convert_audio_to_pcm_falls_back_to_the_original_bytes(monkeypatch):
+    monkeypatch.setattr(main, "load_pydub", lambda: None)
+    assert main.convert_audio_to_pcm(UNDECODABLE_MP3) == (UNDECODABLE_MP3, False)
+
+
+# Streaming bodies
+
+def test_closing_body_runs_on_close_before_iteration():
+    closed = []
+
+    def chunks():
+        try:
+            yield b"audio"
+        finally:
+            closed.append("generator")
+
+    body = main.ClosingBody(chunks(), lambda: closed.append("on_close"))
+    body.close()
+    assert closed == ["on_close"]  # The generator never started, so its finally never ran
+
+
+def test_tts_streams_matching_wav_and_caches_it(client, deepdub):
+    first = post_tts(client)
+    assert first.status_code == 200
+    assert first.headers["X-Cache"] == "MISS"
+    assert first.data == deepdub.body[44:]
+
+    second = post_tts(client)
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.data == first.data
+    assert deepdub.calls == 1
+
+
+def test_tts_revalidates_with_etag_and_varies_on_accept(client, deepdub):
+    first = post_tts(client)
+    assert first.data == deepdub.body[44:]
+    assert first.headers["Vary"] == "Accept"
+
+    revalidated = post_tts(client, headers={"If-None-Match": first.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["Vary"] == "Accept"
+    assert post_tts(client, headers={"If-None-Match": "*"}).status_code == 200
+
+    wav = post_tts(client, headers={"Accept": "audio/wav", "If-None-Match": first.headers["ETag"]})
+    assert wav.status_code == 200  # Different variant, different ETag
+    assert wav.headers["ETag"] != first.headers["ETag"]
+
+
+def test_tts_closes_deepdub_response_when_client_leaves_early(client, deepdub):
+    response = post_tts(client, buffered=False)
+    response.close()
+    assert deepdub.responses[0].closed
+    assert not main._inflight
+
+
+# Single-flight
+
+def test_concurrent_identical_requests_share_one_deepdub_call(deepdub):
+    deepdub.delay = 0.2
+    results = []
+
+    def request():
+        results.append(post_tts(main.app.test_client()).data)
+
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert deepdub.calls == 1
+    assert results == [deepdub.body[44:]] * 5
+
+
+def test_failed_leader_does_not_leave_followers_waiting(client, deepdub):
+    deepdub.error = requests.exceptions.ConnectionError("refused")
+    response = post_tts(client)
+    assert response.status_code == 500
+    assert response.get_json()["error"].startswith("Network error")
+    assert not main._inflight
+
+
+def test_unexpected_leader_error_resolves_the_inflight_entry(client, deepdub, monkeypatch):
+    def boom(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(main, "stream_tts", boom)
+    started = time.perf_counter()
+    assert post_tts(client).status_code == 500
+    assert post_tts(client).status_code == 500
+    assert time.perf_counter() - started < main.INFLIGHT_WAIT_TIMEOUT
+    assert not main._inflight
+
+
+# Latency histograms
+
+def test_histogram_percentiles_use_bucket_bounds_capped_at_max():
+    histogram = main.LatencyHistogram(buckets=(0.1, 1.0, 10.0))
+    for seconds in (0.05, 0.05, 0.05, 0.5, 2.0):
+        histogram.observe(seconds)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 5
+    assert snapshot["p50_ms"] == 100.0
+    assert snapshot["p99_ms"] == 2000.0  # The 10s bucket bound is capped at the max seen
+    assert snapshot["max_ms"] == 2000.0
+
+
+def test_histogram_overflow_bucket_reports_max():
+    histogram = main.LatencyHistogram(buckets=(0.1,))
+    histogram.observe(3.0)
+    assert histogram.snapshot()["p50_ms"] == 3000.0
+
+
+# Unconvertible audio
+
+
+@pytest.mark.parametrize("as_wav", [False, True])
+def test_unconverted_fallback_is_sent_as_bytes(monkeypatch, as_wav):
+    # WSGI servers reject anything but bytes, and collect_body buffers into a bytearray
+    monkeypatch.setattr(main, "load_pydub", lambda: None)
+    chunks = list(main.stream_audio_body(FakeResponse(UNDECODABLE_MP3, "audio/mpeg"), 8000, as_wav))
+    assert all(type(chunk) is bytes for chunk in chunks)
+    assert b"".join(chunks).endswith(UNDECODABLE_MP3)
+
+
+def test_unconverted_fallback_is_not_cached(client, deepdub, monkeypatch):
+    monkeypatch.setattr(main, "load_pydub", lambda: None)
+    deepdub.body, deepdub.content_type = UNDECODABLE_MP3, "audio/mpeg"
+
+    for _ in range(2):
+        response = post_tts(client)
+        assert response.status_code == 200
+        assert response.data == UNDECODABLE_MP3
+        assert response.headers["Cache-Control"] == "no-store"
+        assert "ETag" not in response.headers
+
+    assert deepdub.calls == 2
+    assert not main._tts_cache
+    assert not main._inflight
+
+
+def test_unconverted_first_sentence_falls_back_to_the_whole_text(client, deepdub, monkeypatch):
+    monkeypatch.setattr(main, "load_pydub", lambda: None)
+    deepdub.body, deepdub.content_type = UNDECODABLE_MP3, "audio/mpeg"
+    text = "First sentence here. " * 10
+
+    response = post_tts(client, text=text)
+    assert response.data == UNDECODABLE_MP3
+    assert deepdub.calls == 2  # The first sentence, then the text in one request
+
+
+# Stats
+
+def test_stats_does_not_import_the_audio_libraries(client, monkeypatch):
+    for loader in (main.load_numpy, main.load_native_decoder, main.load_pydub):
+        monkeypatch.setattr(main, loader.__name__, functools.cache(pytest.fail))
+    libraries = client.get("/stats").get_json()["libraries"]
+    assert libraries["numpy_available"] is True
+
+
+# Request validation
+
+@pytest.mark.parametrize("sample_rate, status", [
+    (8000, 200),
+    (8000.0, 200),
+    (8000.5, 400),
+    ("8000", 400),
+    ([8000], 400),
+    (12345, 400),
+])
+def test_tts_sample_rate_validation(client, deepdub, sample_rate, status):
+    assert post_tts(client, sample_rate=sample_rate).status_code == status
+
+
+def test_integral_float_sample_rate_shares_the_int_cache_entry(client, deepdub):
+    assert post_tts(client, sample_rate=8000).data
+    assert post_tts(client, sample_rate=8000.0).headers["X-Cache"] == "HIT"